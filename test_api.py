@@ -1,7 +1,6 @@
+import urllib.parse
+
 import requests
-import base64
-from PIL import Image
-import io
 
 # Test the root endpoint
 response = requests.get("http://localhost:7860/")
@@ -12,16 +11,14 @@ image_path = "dock.JPG"  # Replace with your test image path
 with open(image_path, "rb") as img_file:
     files = {"image": img_file}
     data = {"theme_description": "forest landscape", "theme_color": "green"}
-    
+
     response = requests.post("http://localhost:7860/inpaint/", files=files, data=data)
-    
+
     if response.status_code == 200:
-        # Decode and save the result
-        result = response.json()
-        image_data = base64.b64decode(result["image"])
-        result_image = Image.open(io.BytesIO(image_data))
-        result_image.save("inpainted_result.jpg")
+        # The endpoint returns raw JPEG bytes with metadata in headers
+        with open("inpainted_result.jpg", "wb") as out_file:
+            out_file.write(response.content)
         print("Successfully saved inpainted image as 'inpainted_result.jpg'")
-        print("Prompt used:", result["prompt_used"])
+        print("Prompt used:", urllib.parse.unquote(response.headers.get("X-Prompt", "")))
     else:
-        print("Error:", response.status_code, response.text)
\ No newline at end of file
+        print("Error:", response.status_code, response.text)